@@ -1,64 +1,131 @@
 import json
-import uuid
+import logging
+import hashlib
+import concurrent.futures
 import boto3
+import functools
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from botocore.exceptions import ClientError
+import io
 import os
-import urllib3
+import http.client
+import threading
+from urllib.parse import urljoin, urlsplit
 import zlib
+import base64
 
-# Initialize clients
-boto_config = Config(
-    connect_timeout=1, read_timeout=300,
-    retries={'max_attempts': 1})
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-boto_session = boto3.Session()
-s3_client = boto3.client('s3')
-sagemaker = boto3.client('sagemaker')
-bedrock_runtime = boto_session.client(
-    service_name="bedrock-runtime",
-    config=boto_config
-)
+# One shared compact encoder for Bedrock request bodies; raw UTF-8 keeps
+# non-ASCII YAML from inflating into \uXXXX escapes
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
 
-# Initialize urllib3
-http = urllib3.PoolManager()
+def json_dumps(obj):
+    return _json_encoder.encode(obj).encode('utf-8')
 
+# Initialize clients. The Lambda is deployed with Timeout=60, so a read timeout
+# of 45 s leaves time to return the error JSON; the retries cover fast failures
+# such as throttling and connection errors rather than a second slow call
 boto_config = Config(
-    connect_timeout=1, read_timeout=300,
-    retries={'max_attempts': 1})
+    connect_timeout=1, read_timeout=45,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True, max_pool_connections=20)
 
 boto_session = boto3.Session()
-s3_client = boto3.client('s3')
+REGION_NAME = boto_session.region_name
+s3_client = boto_session.client('s3')
+sts_client = boto_session.client('sts', config=boto_config)
 bedrock_runtime = boto_session.client(
     service_name="bedrock-runtime",
     config=boto_config
 )
 
+# Content types for the PlantUML server's output formats
+DIAGRAM_CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'txt': 'text/plain; charset=utf-8',
+    'pdf': 'application/pdf',
+    'eps': 'application/postscript',
+}
+
+# Multipart settings for large diagram uploads. Parts of an in-memory upload are
+# buffered, so chunksize x concurrency (32 MiB) is kept well inside a 128 MB Lambda
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4)
+
+# Persistent worker thread for the bucket lookup that overlaps the Bedrock call
+_IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="uml-io")
+
 # Use PlantUML server instead of local rendering
-PLANTUML_SERVER = "http://www.plantuml.com/plantuml"
+PLANTUML_SERVER = "https://www.plantuml.com/plantuml"
+
+class PlantUMLRenderError(Exception):
+    """Raised when the PlantUML server does not return a rendered diagram"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+# Socket timeout for PlantUML requests, well inside the Lambda's 60 s timeout
+PLANTUML_TIMEOUT = 10
 
+def open_http_connection(url):
+    """Open an HTTP or HTTPS connection to the host of an already split URL"""
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(url.netloc, timeout=PLANTUML_TIMEOUT)
+
+# One keep-alive connection to the PlantUML server, shared across invocations
+_PLANTUML_URL = urlsplit(PLANTUML_SERVER)
+_plantuml_conn = open_http_connection(_PLANTUML_URL)
+_plantuml_lock = threading.Lock()
+
+# Errors that mean the server closed the idle keep-alive socket; only these are retried
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+# Statuses meaning the server does not take POSTed source (including POST
+# redirects that are not followed); anything else, such as a 400 for a
+# PlantUML syntax error, is the final answer
+_POST_UNSUPPORTED_STATUSES = (301, 302, 303, 404, 405, 501)
+_plantuml_post_supported = True
+
+# Redirects are followed up to the same hop limit urllib3 used
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 3
+
+@functools.lru_cache(maxsize=1)
 def get_default_bucket():
-    """Get the default SageMaker bucket for the current region"""
+    """Get the default SageMaker bucket for the current region (resolved once per container)"""
+    account = sts_client.get_caller_identity()['Account']
+    bucket_name = f'sagemaker-{REGION_NAME}-{account}'
+    
+    # Check if bucket exists, if not create it
     try:
-        region = boto3.Session().region_name
-        account = boto3.client('sts').get_caller_identity()['Account']
-        bucket_name = f'sagemaker-{region}-{account}'
+        s3_client.head_bucket(Bucket=bucket_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+            raise
+        s3_client.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={
+                'LocationConstraint': REGION_NAME
+            } if REGION_NAME != 'us-east-1' else {}
+        )
         
-        # Check if bucket exists, if not create it
-        try:
-            s3_client.head_bucket(Bucket=bucket_name)
-        except:
-            s3_client.create_bucket(
-                Bucket=bucket_name,
-                CreateBucketConfiguration={
-                    'LocationConstraint': region
-                } if region != 'us-east-1' else {}
-            )
-            
-        return bucket_name
-    except Exception as e:
-        raise Exception(f"Error getting default bucket: {str(e)}")
+    return bucket_name
 
-def encode_plantuml(plantuml_text):
+# Maps the standard base64 alphabet onto PlantUML's encoding alphabet
+_PLANTUML_TRANS = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",
+    b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_")
+
+@functools.lru_cache(maxsize=128)
+def encode_plantuml(plantuml_text, level=9):
     """
     Encode PlantUML text using the correct deflate + base64 encoding
     """
@@ -68,43 +135,90 @@ def encode_plantuml(plantuml_text):
     # Add proper PlantUML markers
     plantuml_text = f"@startuml\n{plantuml_text}\n@enduml"
     
-    # Compress using zlib
-    compressed = zlib.compress(plantuml_text.encode('utf-8'))[2:-4]
+    # Compress to a raw deflate stream (no zlib header or Adler-32 trailer)
+    compressor = zlib.compressobj(level=level, wbits=-15)
+    compressed = compressor.compress(plantuml_text.encode('utf-8')) + compressor.flush()
     
-    # Encode using PlantUML's modified base64
-    base64_chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
-    encoded = ""
-    for i in range(0, len(compressed), 3):
-        chunk = compressed[i:i + 3]
-        b = list(chunk) + [0] * (3 - len(chunk))
-        b1 = b[0] >> 2
-        b2 = ((b[0] & 0x3) << 4) | (b[1] >> 4)
-        b3 = ((b[1] & 0xF) << 2) | (b[2] >> 6)
-        b4 = b[2] & 0x3F
-        encoded += base64_chars[b1] + base64_chars[b2]
-        if len(chunk) > 1:
-            encoded += base64_chars[b3]
-        if len(chunk) > 2:
-            encoded += base64_chars[b4]
+    # Encode using PlantUML's modified base64 (a remapped standard alphabet)
+    encoded = base64.b64encode(compressed).translate(_PLANTUML_TRANS).rstrip(b"=").decode("ascii")
     
     return encoded
 
-def get_diagram_from_server(plantuml_code, output_format='png'):
+def request_once(url, method, body=None, headers=None):
     """
-    Get diagram from PlantUML server using urllib3
+    Send one request to an absolute URL over a throwaway connection and
+    return (status, data, location)
     """
+    target = urlsplit(url)
+    conn = open_http_connection(target)
     try:
+        path = target.path + (f"?{target.query}" if target.query else "")
+        conn.request(method, path or "/", body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read(), response.getheader('Location')
+    finally:
+        conn.close()
+
+def plantuml_request(method, path, body=None, headers=None):
+    """
+    Send a request over the shared PlantUML connection and return (status, data).
+    The request is resent once if the server had dropped the idle connection;
+    timeouts and other errors are raised straight away. Redirects (e.g. HTTP to
+    HTTPS, or to another host) are followed on separate connections.
+    """
+    with _plantuml_lock:
+        for attempt in range(2):
+            try:
+                _plantuml_conn.request(method, _PLANTUML_URL.path + path, body=body, headers=headers or {})
+                response = _plantuml_conn.getresponse()
+                status, data, location = response.status, response.read(), response.getheader('Location')
+                break
+            except _STALE_CONNECTION_ERRORS:
+                _plantuml_conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                # Leave the connection in a clean state for the next invocation
+                _plantuml_conn.close()
+                raise
+    
+    url = PLANTUML_SERVER + path
+    for _ in range(_MAX_REDIRECTS):
+        if status not in _REDIRECT_STATUSES or not location:
+            break
+        # Only 307/308 keep a POST body; other redirects of a POST are left to
+        # the caller, which falls back to the encoded GET URL
+        if method != 'GET' and status not in (307, 308):
+            break
+        url = urljoin(url, location)
+        status, data, location = request_once(url, method, body, headers)
+    
+    return status, data
+
+def get_diagram_from_server(plantuml_code, output_format='png'):
+    """
+    Get diagram from PlantUML server. The source is POSTed as-is; once the
+    server rejects POST, this and later calls use the deflate-encoded GET URL.
+    """
+    global _plantuml_post_supported
+    
+    if _plantuml_post_supported:
+        status, data = plantuml_request(
+            'POST', f"/{output_format}/",
+            body=plantuml_code.encode('utf-8'),
+            headers={'Content-Type': 'text/plain'})
+        if status in _POST_UNSUPPORTED_STATUSES:
+            # Remember for this container so later renders go straight to GET
+            _plantuml_post_supported = False
+    
+    if not _plantuml_post_supported:
         encoded = encode_plantuml(plantuml_code)
-        url = f"http://www.plantuml.com/plantuml/{output_format}/{encoded}"
-        
-        response = http.request('GET', url)
-        
-        if response.status == 200:
-            return response.data
-        else:
-            raise Exception(f"Failed to get diagram: HTTP {response.status}")
-    except Exception as e:
-        raise Exception(f"Error getting diagram from server: {str(e)}")
+        status, data = plantuml_request('GET', f"/{output_format}/{encoded}")
+    
+    if status == 200:
+        return data
+    else:
+        raise PlantUMLRenderError(f"Failed to get diagram: HTTP {status}", status)
 
 
 code_generation = """
@@ -188,8 +302,22 @@ Important Instructions:
 Generate ONLY the PlantUML code without any additional explanation or text.
 """
 
-# Add S3 client for storing generated diagrams
-s3_client = boto3.client('s3')
+# Split the templates once so each request is a single concatenation
+_CG_P0, _CG_REST = code_generation.split("{YAML_FILE}")
+_CG_P1, _CG_P2 = _CG_REST.split("{USER_QUERY}")
+_UML_PREFIX, _UML_SUFFIX = uml_generation.split("{YAML_FILE}")
+
+def read_response_text(response):
+    """
+    Return the text of the first content block of a Bedrock Claude response
+    """
+    response_body = json.loads(response["body"].read())
+    first_block = next(iter(response_body.get("content") or ()), None)
+    
+    text = first_block.get("text") if isinstance(first_block, dict) else None
+    if text is None:
+        raise ValueError("Bedrock response has no text in content[0]")
+    return text
 
 def get_named_parameter(event, name, default=None):
     """
@@ -210,41 +338,32 @@ def get_named_parameter(event, name, default=None):
 
 def extract_plantuml_code(response_text):
     """
-    Extract PlantUML code from the response text with better error handling
+    Extract PlantUML code from the response text. A ```plantuml fence wins over a
+    bare @startuml, and a closing ``` is preferred over @enduml as the end marker.
     """
-    try:
-        # First try to find code between ```plantuml and ``` markers
-        start_markers = ["```plantuml", "@startuml"]
-        end_markers = ["```", "@enduml"]
-        
-        for start_marker in start_markers:
-            if start_marker in response_text:
-                start_idx = response_text.index(start_marker)
-                # If we found ```plantuml, we need to skip over it
-                if start_marker == "```plantuml":
-                    start_idx += len(start_marker)
-                
-                # Find the corresponding end marker
-                for end_marker in end_markers:
-                    try:
-                        end_idx = response_text.index(end_marker, start_idx)
-                        code = response_text[start_idx:end_idx].strip()
-                        
-                        # Ensure the code has the required @startuml and @enduml tags
-                        if not code.startswith("@startuml"):
-                            code = "@startuml\n" + code
-                        if not code.endswith("@enduml"):
-                            code = code + "\n@enduml"
-                            
-                        return code
-                    except ValueError:
-                        continue
-                        
-        # If we get here, we couldn't find valid markers
-        raise ValueError("No valid PlantUML code markers found")
+    for start_marker in ("```plantuml", "@startuml"):
+        start_idx = response_text.find(start_marker)
+        if start_idx == -1:
+            continue
+        # If we found ```plantuml, we need to skip over it
+        if start_marker == "```plantuml":
+            start_idx += len(start_marker)
         
-    except Exception as e:
-        raise ValueError(f"Could not extract PlantUML code: {str(e)}")
+        for end_marker in ("```", "@enduml"):
+            end_idx = response_text.find(end_marker, start_idx)
+            if end_idx == -1:
+                continue
+            
+            # Ensure the code has the required @startuml and @enduml tags
+            code = response_text[start_idx:end_idx].strip()
+            if not code.startswith("@startuml"):
+                code = "@startuml\n" + code
+            if not code.endswith("@enduml"):
+                code = code + "\n@enduml"
+            
+            return code
+    
+    raise ValueError("Could not extract PlantUML code: No valid PlantUML code markers found")
 
 def generate_diagram(plantuml_code, output_format='png'):
     """
@@ -271,35 +390,71 @@ def generate_diagram(plantuml_code, output_format='png'):
     except Exception as e:
         raise Exception(f"Error generating diagram: {str(e)}")
 
-def upload_to_s3(diagram_data, key):
+def diagram_exists(bucket_name, key):
     """
-    Upload generated diagram to S3 using default SageMaker bucket and return S3 URI
+    Check whether a diagram has already been stored under the given key
     """
     try:
-        bucket_name = get_default_bucket()
-        
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        return False
+
+def upload_to_s3(diagram_data, key, output_format='png'):
+    """
+    Upload generated diagram to S3 using default SageMaker bucket and return S3 URI
+    """
+    bucket_name = get_default_bucket()
+    
+    # Content-addressed objects never change, so they can be cached indefinitely.
+    # CRC32 is computed by zlib in C; CRC32C would need the optional awscrt package.
+    upload_args = {
+        'ContentType': DIAGRAM_CONTENT_TYPES.get(output_format, 'application/octet-stream'),
+        'CacheControl': 'public, max-age=31536000, immutable',
+        'ChecksumAlgorithm': 'CRC32'
+    }
+    
+    # Small diagrams go up in a single PUT; only large renders pay for multipart
+    if len(diagram_data) < MULTIPART_THRESHOLD:
         s3_client.put_object(
             Bucket=bucket_name,
             Key=key,
             Body=diagram_data,
-            ContentType='image/png'
+            **upload_args
         )
-        
-        # Generate S3 URI instead of presigned URL
-        s3_uri = f"s3://{bucket_name}/{key}"
-        
-        return s3_uri
-    except Exception as e:
-        raise Exception(f"Error uploading to S3: {str(e)}")
+    else:
+        s3_client.upload_fileobj(
+            io.BytesIO(diagram_data),
+            bucket_name,
+            key,
+            Config=transfer_config,
+            ExtraArgs=upload_args
+        )
+    
+    # Generate S3 URI instead of presigned URL
+    s3_uri = f"s3://{bucket_name}/{key}"
+    
+    return s3_uri
 
-def get_uml_diagram(yml_code, output_format='png'):
+def get_uml_diagram(yml_code, output_format='png', upload=True):
+    """
+    Generate a UML diagram for the YAML file. With upload=False the diagram is
+    not rendered or stored; the PlantUML server URL for it is returned instead.
+    """
+    bucket_future = None
     try:
+        # Resolve the target bucket while Claude is generating the diagram
+        if upload:
+            bucket_future = _IO_POOL.submit(get_default_bucket)
+        
         content = []
-        prompt = uml_generation.replace("{YAML_FILE}", yml_code)
+        prompt = _UML_PREFIX + yml_code + _UML_SUFFIX
         query_obj = {"type": "text", "text": prompt}
         content.append(query_obj)
 
-        body = json.dumps({
+        body = json_dumps({
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 4096,
             "messages": [
@@ -314,20 +469,31 @@ def get_uml_diagram(yml_code, output_format='png'):
             modelId="anthropic.claude-3-sonnet-20240229-v1:0",
             body=body)
         
-        response_body = json.loads(response.get("body").read())
-        plantuml_text = response_body["content"][0]["text"]
+        plantuml_text = read_response_text(response)
         
         print(f"Claude Response: {plantuml_text}")
         
         plantuml_code = extract_plantuml_code(plantuml_text)
         print(f"Extracted PlantUML code: {plantuml_code}")
         
-        # Get diagram from PlantUML server
-        diagram_data = get_diagram_from_server(plantuml_code, output_format)
+        if not upload:
+            return {
+                "codeBody": plantuml_code,
+                "diagramUri": f"{PLANTUML_SERVER}/{output_format}/{encode_plantuml(plantuml_code)}"
+            }
+        
+        # Key by the PlantUML source so identical diagrams are stored once and a
+        # repeat request can be answered before anything is rendered
+        digest = hashlib.blake2b(plantuml_code.encode('utf-8'), digest_size=16).hexdigest()
+        file_name = f"diagrams/{digest}.{output_format}"
         
-        # Upload to S3 with a unique filename
-        file_name = f"diagrams/{uuid.uuid4()}.{output_format}"
-        diagram_s3_uri = upload_to_s3(diagram_data, file_name)
+        # Only render and upload when the diagram is not already in S3
+        bucket_name = bucket_future.result()
+        if diagram_exists(bucket_name, file_name):
+            diagram_s3_uri = f"s3://{bucket_name}/{file_name}"
+        else:
+            diagram_data = get_diagram_from_server(plantuml_code, output_format)
+            diagram_s3_uri = upload_to_s3(diagram_data, file_name, output_format)
         
         return {
             "codeBody": plantuml_code,
@@ -336,6 +502,9 @@ def get_uml_diagram(yml_code, output_format='png'):
         
     except Exception as e:
         logger.error(f"Error in get_uml_diagram: {str(e)}")
+        # Don't leave the bucket prefetch running past this invocation
+        if bucket_future is not None and not bucket_future.cancel():
+            bucket_future.exception()
         return {
             "error": str(e),
             "codeBody": None,
@@ -349,14 +518,13 @@ def get_unit_test_code(yml_code, query):
     """
     content = []
 
-    prompt = code_generation.replace("{YAML_FILE}",yml_code)
-    prompt = prompt.replace("{USER_QUERY}",query)
+    prompt = _CG_P0 + yml_code + _CG_P1 + query + _CG_P2
 
     query_obj = {"type": "text", "text": prompt}
 
     content.append(query_obj)
 
-    body = json.dumps(
+    body = json_dumps(
         {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 4096,
@@ -373,9 +541,7 @@ def get_unit_test_code(yml_code, query):
         modelId="anthropic.claude-3-sonnet-20240229-v1:0",
         body=body)
     
-    response_body = json.loads(response.get("body").read())
-    
-    return {"codeBody": response_body["content"][0]["text"]}
+    return {"codeBody": read_response_text(response)}
 
 def lambda_handler(event, context):
     actionGroup = event.get('actionGroup', '')
@@ -4,8 +4,12 @@ import uuid
 import os
 from datetime import datetime
 import logging
-import urllib3
+import functools
+import http.client
+import threading
+from urllib.parse import urljoin, urlsplit
 import zlib
+import base64
 
 # Set up logging
 logger = logging.getLogger()
@@ -14,10 +18,47 @@ logger.setLevel(logging.INFO)
 s3_client = boto3.client('s3')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'swagger-diagrams-bucket-1730133000')
 
-# Initialize urllib3
-http = urllib3.PoolManager()
+PLANTUML_SERVER = "https://www.plantuml.com/plantuml"
 
-def encode_plantuml(plantuml_text):
+class PlantUMLRenderError(Exception):
+    """Raised when the PlantUML server does not return a rendered diagram"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+# Socket timeout for PlantUML requests, well inside the Lambda's 60 s timeout
+PLANTUML_TIMEOUT = 10
+
+def open_http_connection(url):
+    """Open an HTTP or HTTPS connection to the host of an already split URL"""
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(url.netloc, timeout=PLANTUML_TIMEOUT)
+
+# One keep-alive connection to the PlantUML server, shared across invocations
+_PLANTUML_URL = urlsplit(PLANTUML_SERVER)
+_plantuml_conn = open_http_connection(_PLANTUML_URL)
+_plantuml_lock = threading.Lock()
+
+# Errors that mean the server closed the idle keep-alive socket; only these are retried
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+# Statuses meaning the server does not take POSTed source (including POST
+# redirects that are not followed); anything else, such as a 400 for a
+# PlantUML syntax error, is the final answer
+_POST_UNSUPPORTED_STATUSES = (301, 302, 303, 404, 405, 501)
+_plantuml_post_supported = True
+
+# Redirects are followed up to the same hop limit urllib3 used
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 3
+
+# Maps the standard base64 alphabet onto PlantUML's encoding alphabet
+_PLANTUML_TRANS = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",
+    b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_")
+
+@functools.lru_cache(maxsize=128)
+def encode_plantuml(plantuml_text, level=9):
     """Encode PlantUML text using the correct deflate + base64 encoding"""
     # Remove @startuml and @enduml if present
     plantuml_text = plantuml_text.replace("@startuml", "").replace("@enduml", "").strip()
@@ -25,49 +66,87 @@ def encode_plantuml(plantuml_text):
     # Add proper PlantUML markers
     plantuml_text = f"@startuml\n{plantuml_text}\n@enduml"
     
-    # Compress using zlib
-    compressed = zlib.compress(plantuml_text.encode('utf-8'))[2:-4]
-    
-    # Encode using PlantUML's modified base64
-    base64_chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
-    encoded = ""
-    
-    for i in range(0, len(compressed), 3):
-        chunk = compressed[i:i+3]
-        if len(chunk) == 3:
-            b1, b2, b3 = chunk[0], chunk[1], chunk[2]
-            encoded += base64_chars[b1 >> 2]
-            encoded += base64_chars[((b1 & 0x03) << 4) | (b2 >> 4)]
-            encoded += base64_chars[((b2 & 0x0F) << 2) | (b3 >> 6)]
-            encoded += base64_chars[b3 & 0x3F]
-        elif len(chunk) == 2:
-            b1, b2 = chunk[0], chunk[1]
-            encoded += base64_chars[b1 >> 2]
-            encoded += base64_chars[((b1 & 0x03) << 4) | (b2 >> 4)]
-            encoded += base64_chars[(b2 & 0x0F) << 2]
-        elif len(chunk) == 1:
-            b1 = chunk[0]
-            encoded += base64_chars[b1 >> 2]
-            encoded += base64_chars[(b1 & 0x03) << 4]
+    # Compress to a raw deflate stream (no zlib header or Adler-32 trailer)
+    compressor = zlib.compressobj(level=level, wbits=-15)
+    compressed = compressor.compress(plantuml_text.encode('utf-8')) + compressor.flush()
+    
+    # Encode using PlantUML's modified base64 (a remapped standard alphabet)
+    encoded = base64.b64encode(compressed).translate(_PLANTUML_TRANS).rstrip(b"=").decode("ascii")
     
     return encoded
 
-def get_diagram_from_server(plantuml_code, output_format='png'):
-    """Get diagram from PlantUML server using urllib3"""
+def request_once(url, method, body=None, headers=None):
+    """
+    Send one request to an absolute URL over a throwaway connection and
+    return (status, data, location)
+    """
+    target = urlsplit(url)
+    conn = open_http_connection(target)
     try:
+        path = target.path + (f"?{target.query}" if target.query else "")
+        conn.request(method, path or "/", body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read(), response.getheader('Location')
+    finally:
+        conn.close()
+
+def plantuml_request(method, path, body=None, headers=None):
+    """
+    Send a request over the shared PlantUML connection and return (status, data).
+    The request is resent once if the server had dropped the idle connection;
+    timeouts and other errors are raised straight away. Redirects (e.g. HTTP to
+    HTTPS, or to another host) are followed on separate connections.
+    """
+    with _plantuml_lock:
+        for attempt in range(2):
+            try:
+                _plantuml_conn.request(method, _PLANTUML_URL.path + path, body=body, headers=headers or {})
+                response = _plantuml_conn.getresponse()
+                status, data, location = response.status, response.read(), response.getheader('Location')
+                break
+            except _STALE_CONNECTION_ERRORS:
+                _plantuml_conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                # Leave the connection in a clean state for the next invocation
+                _plantuml_conn.close()
+                raise
+    
+    url = PLANTUML_SERVER + path
+    for _ in range(_MAX_REDIRECTS):
+        if status not in _REDIRECT_STATUSES or not location:
+            break
+        # Only 307/308 keep a POST body; other redirects of a POST are left to
+        # the caller, which falls back to the encoded GET URL
+        if method != 'GET' and status not in (307, 308):
+            break
+        url = urljoin(url, location)
+        status, data, location = request_once(url, method, body, headers)
+    
+    return status, data
+
+def get_diagram_from_server(plantuml_code, output_format='png'):
+    """Get diagram from PlantUML server, POSTing the source with an encoded GET fallback"""
+    global _plantuml_post_supported
+    
+    if _plantuml_post_supported:
+        status, data = plantuml_request(
+            'POST', f"/{output_format}/",
+            body=plantuml_code.encode('utf-8'),
+            headers={'Content-Type': 'text/plain'})
+        if status in _POST_UNSUPPORTED_STATUSES:
+            # Remember for this container so later renders go straight to GET
+            _plantuml_post_supported = False
+    
+    if not _plantuml_post_supported:
         encoded = encode_plantuml(plantuml_code)
-        url = f"http://www.plantuml.com/plantuml/{output_format}/{encoded}"
-        
-        response = http.request('GET', url)
-        
-        if response.status == 200:
-            return response.data
-        else:
-            raise Exception(f"PlantUML server returned status {response.status}")
-            
-    except Exception as e:
-        logger.error(f"Error getting diagram from server: {str(e)}")
-        raise
+        status, data = plantuml_request('GET', f"/{output_format}/{encoded}")
+    
+    if status == 200:
+        return data
+    else:
+        raise PlantUMLRenderError(f"PlantUML server returned status {status}", status)
 
 def lambda_handler(event, context):
     """Generate UML diagram from OpenAPI YAML specification"""
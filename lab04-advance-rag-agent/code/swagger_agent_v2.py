@@ -81,11 +81,11 @@ def retrieve_swagger_spec(query: str) -> str:
             }
         )
         
-        results = []
-        for result in response.get('retrievalResults', []):
-            content = result.get('content', {}).get('text', '')
-            if content:
-                results.append(content)
+        results = [
+            text
+            for result in response.get('retrievalResults', ())
+            if (text := result.get('content', {}).get('text', ''))
+        ]
         
         if results:
             return f"Found {len(results)} relevant API specifications:\n\n" + "\n\n---\n\n".join(results)